@@ -1,59 +1,99 @@
 import time
 import json
 import argparse
-import AWSIoTPythonSDK.MQTTLib as AWSIoTPyMQTT
-
-# 引数の解析
-parser = argparse.ArgumentParser()
-parser.add_argument("--endpoint", required=True, help="AWS IoT Core endpoint")
-parser.add_argument("--cert", required=True, help="Path to certificate file")
-parser.add_argument("--key", required=True, help="Path to private key file")
-parser.add_argument("--ca", required=True, help="Path to CA certificate file (rootCA.pem)")
-parser.add_argument("--device-id", required=True, help="Device ID (used as client ID)")
-args = parser.parse_args()
-
-# MQTT クライアントの設定
-client_id = args.device_id
-mqtt_client = AWSIoTPyMQTT.AWSIoTMQTTClient(client_id)
-mqtt_client.configureEndpoint(args.endpoint, 8883)
-mqtt_client.configureCredentials(args.ca, args.key, args.cert)
-
-# MQTT 接続パラメータの設定
-mqtt_client.configureAutoReconnectBackoffTime(1, 32, 20)
-mqtt_client.configureOfflinePublishQueueing(-1)
-mqtt_client.configureDrainingFrequency(2)
-mqtt_client.configureConnectDisconnectTimeout(10)
-mqtt_client.configureMQTTOperationTimeout(5)
-
-# 接続コールバック関数
-def simple_on_online_callback():
-    print("Client is online.")
-
-# onOnlineイベントに関数を割り当て（接続成功時に呼び出される）
-mqtt_client.onOnline = simple_on_online_callback
-
-# 接続試行
-print(f"Attempting to connect to AWS IoT Core as device {args.device_id}...")
-try:
-    if mqtt_client.connect(10): # 接続タイムアウト10秒
-        print("Connection successful.")
-        # メッセージ発行
-        topic = f"devices/{args.device_id}/status"
-        message = {
-            "message": f"Hello from device {args.device_id}",
-            "timestamp": time.time()
-        }
-        print(f"Publishing message to topic: {topic}")
-        mqtt_client.publish(topic, json.dumps(message), 1) # QoS 1
-
-        # メッセージが送信され、コールバックが処理されるのを少し待つ
-        # 実際のアプリケーションではこのような固定待機ではなく、適切なイベント処理を行う
-        time.sleep(5)
-        print("Disconnecting...")
-        mqtt_client.disconnect()
-        print("Disconnected.")
-    else:
-        # connect()がFalseを返した場合 (タイムアウトまたは即時接続失敗)
-        print("Connect attempt failed or timed out.")
-except Exception as e:
-    print(f"An error occurred: {str(e)}")
\ No newline at end of file
+from awscrt import mqtt
+from awsiot import mqtt_connection_builder
+
+
+class DeviceClient:
+    """TLS+MQTTセッションを保持したまま複数回 publish するためのクライアント
+
+    メッセージごとに接続・切断を繰り返すと毎回フルTLSハンドシェイクが
+    発生するため、接続は一度だけ行い使い回す。awscrt ベースの
+    mqtt_connection は再接続時にTLSセッション再開（session ticket）を
+    利用するため、切断からの復帰もフルハンドシェイクより大幅に速い。
+    """
+
+    def __init__(self, endpoint, ca, key, cert, client_id):
+        self.client_id = client_id
+        # 接続オブジェクトは一つだけ作り、再接続もこのオブジェクトに任せる
+        self.mqtt_connection = mqtt_connection_builder.mtls_from_path(
+            endpoint=endpoint,
+            port=8883,
+            cert_filepath=cert,
+            pri_key_filepath=key,
+            ca_filepath=ca,
+            client_id=client_id,
+            clean_session=False,
+            keep_alive_secs=30,
+            on_connection_interrupted=self._on_interrupted,
+            on_connection_resumed=self._on_resumed,
+        )
+
+    def _on_interrupted(self, connection, error, **kwargs):
+        print(f"Connection interrupted: {error}")
+
+    def _on_resumed(self, connection, return_code, session_present, **kwargs):
+        # session_present が True ならセッション再開に成功している
+        print(f"Connection resumed (return_code={return_code}, session_present={session_present})")
+
+    def connect(self, timeout=10):
+        """一度だけ接続する（以降の publish はこのセッションを使い回す）"""
+        print(f"Attempting to connect to AWS IoT Core as device {self.client_id}...")
+        try:
+            self.mqtt_connection.connect().result(timeout)
+            return True
+        except Exception as e:
+            print(f"Connect failed: {str(e)}")
+            return False
+
+    def publish(self, topic, message):
+        """保持中のセッションでメッセージを発行する（再接続しない）"""
+        publish_future, _ = self.mqtt_connection.publish(
+            topic=topic,
+            payload=json.dumps(message),
+            qos=mqtt.QoS.AT_LEAST_ONCE,
+        )
+        publish_future.result(5)  # QoS 1 の PUBACK を待つ
+
+    def disconnect(self):
+        self.mqtt_connection.disconnect().result(10)
+
+
+if __name__ == "__main__":
+    # 引数の解析
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--endpoint", required=True, help="AWS IoT Core endpoint")
+    parser.add_argument("--cert", required=True, help="Path to certificate file")
+    parser.add_argument("--key", required=True, help="Path to private key file")
+    parser.add_argument("--ca", required=True, help="Path to CA certificate file (rootCA.pem)")
+    parser.add_argument("--device-id", required=True, help="Device ID (used as client ID)")
+    parser.add_argument("--count", type=int, default=5, help="Number of messages to publish")
+    parser.add_argument("--interval", type=float, default=1.0, help="Seconds to wait between publishes")
+    args = parser.parse_args()
+
+    device = DeviceClient(args.endpoint, args.ca, args.key, args.cert, args.device_id)
+
+    try:
+        if device.connect():
+            print("Connection successful.")
+            topic = f"devices/{args.device_id}/status"
+            # 同一セッションで繰り返し発行（接続・切断を繰り返さない）
+            for i in range(args.count):
+                message = {
+                    "message": f"Hello from device {args.device_id}",
+                    "sequence": i,
+                    "timestamp": time.time()
+                }
+                print(f"Publishing message {i + 1}/{args.count} to topic: {topic}")
+                device.publish(topic, message)
+                time.sleep(args.interval)
+
+            print("Disconnecting...")
+            device.disconnect()
+            print("Disconnected.")
+        else:
+            # connect()がFalseを返した場合 (タイムアウトまたは即時接続失敗)
+            print("Connect attempt failed or timed out.")
+    except Exception as e:
+        print(f"An error occurred: {str(e)}")
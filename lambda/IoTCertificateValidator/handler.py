@@ -1,68 +1,193 @@
+import base64
 import boto3
 import json
 import os
 import logging
-from OpenSSL import crypto
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
+from cachetools import TTLCache
+from botocore.config import Config
+from botocore.exceptions import ClientError
 import datetime
 
+# cryptography はインポートが重いため、証明書パースが実際に必要になるまで
+# 読み込みを遅延させる（コールドスタートの短縮）
+_x509 = None
+_NameOID = None
+
+def _load_x509():
+    """cryptography の x509 モジュールを初回利用時に読み込む"""
+    global _x509, _NameOID
+    if _x509 is None:
+        from cryptography import x509
+        from cryptography.x509.oid import NameOID
+        _x509 = x509
+        _NameOID = NameOID
+    return _x509, _NameOID
+
+# pyasn1 も同様に初回利用時まで読み込みを遅延させる
+_pyasn1 = None
+
+def _load_pyasn1():
+    """pyasn1 の DER デコーダと証明書スキーマを初回利用時に読み込む"""
+    global _pyasn1
+    if _pyasn1 is None:
+        from pyasn1.codec.der import decoder
+        from pyasn1_modules import rfc2459
+        _pyasn1 = (decoder, rfc2459)
+    return _pyasn1
+
+# subject 属性の OID（X.520）
+_OID_SERIAL_NUMBER = '2.5.4.5'
+_OID_COMMON_NAME = '2.5.4.3'
+
 # ロガーの設定
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
 # AWS SDKクライアント
-iot_client = boto3.client('iot')
-dynamodb = boto3.resource('dynamodb')
+# 接続を keep-alive で使い回し、呼び出しごとのTLSハンドシェイクを回避する
+_boto_config = Config(
+    max_pool_connections=16,
+    tcp_keepalive=True,
+    retries={'max_attempts': 3, 'mode': 'adaptive'},
+)
+iot_client = boto3.client('iot', config=_boto_config)
+# DAX_ENDPOINT が設定されていれば DynamoDB Accelerator 経由で読み取る
+if os.environ.get('DAX_ENDPOINT'):
+    import amazondax
+    dynamodb = amazondax.AmazonDaxClient.resource(endpoint_url=os.environ['DAX_ENDPOINT'])
+else:
+    dynamodb = boto3.resource('dynamodb')
 # 環境変数からDynamoDBテーブル名を取得
 device_table_name = os.environ['DEVICE_WHITELIST_TABLE']
 device_table = dynamodb.Table(device_table_name)
 
+# ホワイトリスト判定の短期キャッシュ（device_id -> bool、60秒TTL）
+WHITELIST_CACHE = TTLCache(maxsize=10000, ttl=60)
+
+# このコンテナで実施済みのアタッチの記録（attach_* は冪等なので
+# プロセス再起動で空になっても安全。再登録時の余分な往復を省く）
+_ATTACH_CACHE = set()
+
+# リージョンとアカウントIDはコンテナ起動時に一度だけ解決する
+# （ウォームスタート時の STS 呼び出しを省くため）
+AWS_REGION = os.environ.get('AWS_REGION')
+try:
+    ACCOUNT_ID = boto3.client('sts', config=_boto_config).get_caller_identity()['Account']
+except Exception:
+    # 環境が未準備の場合は初回利用時まで遅延させる
+    ACCOUNT_ID = None
+
+def _get_account_id():
+    """アカウントIDを取得する（モジュールロード時に解決済みならそれを返す）"""
+    global ACCOUNT_ID
+    if ACCOUNT_ID is None:
+        ACCOUNT_ID = boto3.client('sts', config=_boto_config).get_caller_identity()['Account']
+    return ACCOUNT_ID
+
+# ポリシードキュメントのJSONテンプレート
+# リージョンとアカウントIDを焼き込み、device_id のみ実行時に差し込む
+_DEVICE_ID_SENTINEL = '@@DEVICE_ID@@'
+_POLICY_TEMPLATE = None
+
+def _get_policy_template():
+    """device_id 差し込み用のポリシーJSONテンプレートを返す（初回のみ構築）"""
+    global _POLICY_TEMPLATE
+    if _POLICY_TEMPLATE is None:
+        region = AWS_REGION
+        account_id = _get_account_id()
+        policy_document = {
+            "Version": "2012-10-17",
+            "Statement": [
+                {
+                    "Effect": "Allow",
+                    "Action": ["iot:Connect"],
+                    "Resource": [f"arn:aws:iot:{region}:{account_id}:client/{_DEVICE_ID_SENTINEL}"]  # Client ID を device_id に制限
+                },
+                {
+                    "Effect": "Allow",
+                    "Action": ["iot:Publish", "iot:Receive"],
+                    "Resource": [f"arn:aws:iot:{region}:{account_id}:topic/devices/{_DEVICE_ID_SENTINEL}/*"]  # トピックを device_id に制限
+                },
+                {
+                    "Effect": "Allow",
+                    "Action": ["iot:Subscribe"],
+                    "Resource": [f"arn:aws:iot:{region}:{account_id}:topicfilter/devices/{_DEVICE_ID_SENTINEL}/*"]  # トピックフィルターを device_id に制限
+                }
+            ]
+        }
+        _POLICY_TEMPLATE = json.dumps(policy_document)
+    return _POLICY_TEMPLATE
+
 def lambda_handler(event, context):
     """
     JITR証明書登録イベントを処理するLambda関数
     """
-    logger.info(f"Received event: {json.dumps(event)}")
-    
+    # DEBUG無効時にシリアライズのコストを払わないよう遅延フォーマットを使う
+    logger.debug("Received event: %s", event)
+
     # 証明書IDを取得
     certificate_id = event['certificateId']
-    logger.info(f"Processing certificate ID: {certificate_id}")
-    
+    # 1リクエスト分の記録をまとめて最後に1レコードで出力する
+    trace = {'certificate_id': certificate_id}
+
     try:
-        # AWS IoT Coreから証明書情報を取得
-        response = iot_client.describe_certificate(
-            certificateId=certificate_id
-        )
-        
-        certificate_pem = response['certificateDescription']['certificatePem']
-        certificate_arn = response['certificateDescription']['certificateArn']
-        
-        # 証明書からデバイスIDを抽出
-        device_id = extract_device_id_from_certificate(certificate_pem)
-        logger.info(f"Extracted device ID: {device_id}")
-        
-        # DynamoDBでデバイスIDの有効性を確認
-        device_response = device_table.get_item(
-            Key={
-                'DeviceId': device_id
-            }
-        )
-        
+        # 証明書情報の取得とデバイスID抽出（同一証明書の再イベントはキャッシュで省略）
+        device_id, certificate_arn = _describe_and_extract(certificate_id)
+        trace['device_id'] = device_id
+
+        # DynamoDBでデバイスIDの有効性を確認（短期キャッシュをまず参照）
+        # 条件付き update_item により、ホワイトリスト判定と登録状態の記録を
+        # 1回の往復で済ませる（項目が存在しない場合は条件エラーになる）
+        if device_id in WHITELIST_CACHE:
+            is_whitelisted = WHITELIST_CACHE[device_id]
+        else:
+            try:
+                device_table.update_item(
+                    Key={
+                        'DeviceId': device_id
+                    },
+                    UpdateExpression='SET registered_at = :t, cert_arn = :a',
+                    ConditionExpression='attribute_exists(DeviceId)',
+                    ExpressionAttributeValues={
+                        ':t': datetime.datetime.now(datetime.UTC).strftime('%Y-%m-%dT%H:%M:%SZ'),
+                        ':a': certificate_arn
+                    }
+                )
+                is_whitelisted = True
+            except ClientError as e:
+                if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+                    is_whitelisted = False
+                else:
+                    raise
+            WHITELIST_CACHE[device_id] = is_whitelisted
+        trace['whitelisted'] = is_whitelisted
+
         # デバイスがホワイトリストに存在するか確認
-        if 'Item' in device_response:
-            # デバイスが有効なので証明書をアクティブ化
-            iot_client.update_certificate(
-                certificateId=certificate_id,
-                newStatus='ACTIVE'
-            )
-            
-            # デバイス用のIoTポリシーを作成して付与
+        if is_whitelisted:
             policy_name = f"DevicePolicy_{device_id}"
-            create_and_attach_policy(policy_name, certificate_arn, device_id) # device_id を渡す
-            
-            # モノを登録して証明書と関連付け
             thing_name = f"Device_{device_id}"
-            register_thing(thing_name, certificate_arn)
-            
-            logger.info(f"Successfully registered device {device_id}")
+            trace['policy_name'] = policy_name
+            trace['thing_name'] = thing_name
+
+            # 証明書のアクティブ化・ポリシー付与・モノ登録は互いに独立なので
+            # 並列実行して往復待ちを重ね合わせる（boto3クライアントはスレッドセーフ）
+            with ThreadPoolExecutor(max_workers=3) as executor:
+                futures = [
+                    executor.submit(
+                        iot_client.update_certificate,
+                        certificateId=certificate_id,
+                        newStatus='ACTIVE'
+                    ),
+                    executor.submit(create_and_attach_policy, policy_name, certificate_arn, device_id),
+                    executor.submit(register_thing, thing_name, certificate_arn),
+                ]
+                for future in futures:
+                    future.result()
+
+            trace['result'] = 'registered'
+            logger.info(json.dumps(trace))
             return {
                 'statusCode': 200,
                 'body': f"Device {device_id} successfully registered"
@@ -73,109 +198,160 @@ def lambda_handler(event, context):
                 certificateId=certificate_id,
                 newStatus='REVOKED'
             )
-            
-            logger.warning(f"Device {device_id} not found in whitelist. Certificate revoked.")
+            # 無効化した証明書をキャッシュに残さない
+            _describe_and_extract.cache_clear()
+
+            trace['result'] = 'revoked_not_whitelisted'
+            logger.warning(json.dumps(trace))
             return {
                 'statusCode': 403,
                 'body': f"Device {device_id} is not authorized"
             }
-            
+
     except Exception as e:
-        logger.error(f"Error processing certificate: {str(e)}")
+        trace['error'] = str(e)
         # エラー発生時も証明書を無効化する
         try:
             iot_client.update_certificate(
                 certificateId=certificate_id,
                 newStatus='REVOKED'
             )
-            logger.info(f"Certificate {certificate_id} revoked due to processing error.")
+            _describe_and_extract.cache_clear()
+            trace['result'] = 'revoked_after_error'
         except Exception as rev_err:
-            logger.error(f"Failed to revoke certificate {certificate_id} after error: {str(rev_err)}")
-            
+            trace['result'] = 'revoke_failed'
+            trace['revoke_error'] = str(rev_err)
+
+        logger.error(json.dumps(trace))
         return {
             'statusCode': 500,
             'body': f"Error: {str(e)}"
         }
 
+def _extract_device_id_der(cert_pem):
+    """PEM本体をbase64デコードし、subject だけをASN.1で読み取る高速パス
+
+    署名検証等を含む完全な証明書オブジェクトを構築せず、
+    tbsCertificate.subject の RDN だけを走査する。
+    見つからなければ None を返し、パース失敗時は例外を送出する。
+    """
+    decoder, rfc2459 = _load_pyasn1()
+    if isinstance(cert_pem, bytes):
+        cert_pem = cert_pem.decode('ascii')
+    body = ''.join(line for line in cert_pem.splitlines() if not line.startswith('-----'))
+    der = base64.b64decode(body)
+    cert, _ = decoder.decode(der, asn1Spec=rfc2459.Certificate())
+
+    found = {}
+    for rdn in cert['tbsCertificate']['subject'].getComponent():
+        for atv in rdn:
+            oid = str(atv['type'])
+            if oid in (_OID_SERIAL_NUMBER, _OID_COMMON_NAME):
+                value, _ = decoder.decode(bytes(atv['value']))
+                found[oid] = str(value)
+
+    if _OID_SERIAL_NUMBER in found:
+        return found[_OID_SERIAL_NUMBER]
+    if _OID_COMMON_NAME in found:  # Common Name をフォールバックとして使用
+        return found[_OID_COMMON_NAME]
+    return None
+
 def extract_device_id_from_certificate(cert_pem):
     """証明書からデバイスIDを抽出する関数"""
+    # まず subject のみを読む高速パスを試し、失敗したら完全パーサへ
     try:
-        x509 = crypto.load_certificate(crypto.FILETYPE_PEM, cert_pem)
-        subject = x509.get_subject()
-        components = dict(subject.get_components())
-        
-        if b'serialNumber' in components:
-            return components[b'serialNumber'].decode('utf-8')
-        if b'CN' in components: # Common Name をフォールバックとして使用
-            return components[b'CN'].decode('utf-8')
-        
+        device_id = _extract_device_id_der(cert_pem)
+        if device_id is not None:
+            return device_id
+    except Exception:
+        logger.debug("Fast DER subject parse failed, falling back to full parser", exc_info=True)
+
+    try:
+        x509, NameOID = _load_x509()
+        if isinstance(cert_pem, str):
+            cert_pem = cert_pem.encode('utf-8')
+        cert = x509.load_pem_x509_certificate(cert_pem)
+        subject = cert.subject
+
+        serial_attrs = subject.get_attributes_for_oid(NameOID.SERIAL_NUMBER)
+        if serial_attrs:
+            return serial_attrs[0].value
+        cn_attrs = subject.get_attributes_for_oid(NameOID.COMMON_NAME) # Common Name をフォールバックとして使用
+        if cn_attrs:
+            return cn_attrs[0].value
+
         raise ValueError("No device ID (serialNumber or CN) found in certificate subject")
     except Exception as e:
         logger.error(f"Error extracting device ID: {str(e)}")
         raise
 
+@lru_cache(maxsize=512)
+def _describe_and_extract(certificate_id):
+    """証明書の記述取得とデバイスID抽出をまとめて行いキャッシュする関数
+
+    ウォームコンテナ内で同じ証明書のイベントが再送された場合、
+    describe_certificate の往復と X.509 パースを省略できる。
+    """
+    response = iot_client.describe_certificate(
+        certificateId=certificate_id
+    )
+    certificate_pem = response['certificateDescription']['certificatePem']
+    certificate_arn = response['certificateDescription']['certificateArn']
+    device_id = extract_device_id_from_certificate(certificate_pem)
+    return device_id, certificate_arn
+
 def create_and_attach_policy(policy_name, certificate_arn, device_id): # device_id を引数に追加
     """IoTポリシーを作成して証明書に付与する関数"""
-    # Lambda実行リージョンとアカウントIDを動的に取得
-    region = os.environ['AWS_REGION']
-    account_id = boto3.client('sts').get_caller_identity()['Account']
-
+    # このコンテナで既に付与済みなら何もしない
+    if (policy_name, certificate_arn) in _ATTACH_CACHE:
+        logger.debug(f"Policy {policy_name} already attached (cached)")
+        return
 
     try:
         try:
             iot_client.get_policy(policyName=policy_name)
-            logger.info(f"Policy {policy_name} already exists")
+            logger.debug(f"Policy {policy_name} already exists")
         except iot_client.exceptions.ResourceNotFoundException:
-            logger.info(f"Creating new policy: {policy_name}")
-            policy_document = {
-                "Version": "2012-10-17",
-                "Statement": [
-                    {
-                        "Effect": "Allow",
-                        "Action": ["iot:Connect"],
-                        "Resource": [f"arn:aws:iot:{region}:{account_id}:client/{device_id}"] # Client ID を device_id に制限
-                    },
-                    {
-                        "Effect": "Allow",
-                        "Action": ["iot:Publish", "iot:Receive"],
-                        "Resource": [f"arn:aws:iot:{region}:{account_id}:topic/devices/{device_id}/*"] # トピックを device_id に制限
-                    },
-                    {
-                        "Effect": "Allow",
-                        "Action": ["iot:Subscribe"],
-                        "Resource": [f"arn:aws:iot:{region}:{account_id}:topicfilter/devices/{device_id}/*"] # トピックフィルターを device_id に制限
-                    }
-                ]
-            }
-            
+            logger.debug(f"Creating new policy: {policy_name}")
+            # テンプレートに device_id を差し込むだけでポリシーJSONが完成する
+            # （JSONインジェクションを防ぐため json.dumps でエスケープした値を使う）
+            escaped_device_id = json.dumps(device_id)[1:-1]
+            policy_document_json = _get_policy_template().replace(_DEVICE_ID_SENTINEL, escaped_device_id)
+
             iot_client.create_policy(
                 policyName=policy_name,
-                policyDocument=json.dumps(policy_document)
+                policyDocument=policy_document_json
             )
         
         iot_client.attach_policy(
             policyName=policy_name,
             target=certificate_arn
         )
-        logger.info(f"Policy {policy_name} attached to certificate")
+        _ATTACH_CACHE.add((policy_name, certificate_arn))
+        logger.debug(f"Policy {policy_name} attached to certificate")
     except Exception as e:
         logger.error(f"Error creating/attaching policy: {str(e)}")
         raise
 
 def register_thing(thing_name, certificate_arn):
     """モノを登録して証明書に関連付ける関数"""
+    # このコンテナで既に関連付け済みなら何もしない
+    if (thing_name, certificate_arn) in _ATTACH_CACHE:
+        logger.debug(f"Thing {thing_name} already attached (cached)")
+        return
+
     try:
         try:
             iot_client.describe_thing(thingName=thing_name)
-            logger.info(f"Thing {thing_name} already exists")
+            logger.debug(f"Thing {thing_name} already exists")
         except iot_client.exceptions.ResourceNotFoundException:
-            logger.info(f"Creating new thing: {thing_name}")
+            logger.debug(f"Creating new thing: {thing_name}")
             iot_client.create_thing(
                 thingName=thing_name,
                 attributePayload={
                     'attributes': {
                         'source': 'jitr_registration',
-                        'registration_date': datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ') # 修正: ISO 8601 形式の現在時刻
+                        'registration_date': datetime.datetime.now(datetime.UTC).strftime('%Y-%m-%dT%H:%M:%SZ') # ISO 8601 形式の現在時刻（UTC）
                     }
                 }
             )
@@ -184,7 +360,8 @@ def register_thing(thing_name, certificate_arn):
             thingName=thing_name,
             principal=certificate_arn
         )
-        logger.info(f"Certificate attached to thing {thing_name}")
+        _ATTACH_CACHE.add((thing_name, certificate_arn))
+        logger.debug(f"Certificate attached to thing {thing_name}")
     except Exception as e:
         logger.error(f"Error registering thing: {str(e)}")
         raise 
\ No newline at end of file
@@ -40,7 +40,7 @@ export class AwsIotJitrLambdaCdkStack extends cdk.Stack {
     });
 
 
-    deviceWhitelistTable.grantReadData(certificateValidatorLambda);
+    deviceWhitelistTable.grantReadWriteData(certificateValidatorLambda);
 
     certificateValidatorLambda.addToRolePolicy(new iam.PolicyStatement({
       actions: [